@@ -1,58 +1,77 @@
+import json
 import os
-import traceback
+import time
 import logging
-from typing import Dict
+from functools import lru_cache
+from threading import Lock
+from typing import Dict, Iterator
 import dspy
+import httpx
+from cachetools import TTLCache
 from openai import OpenAI
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    filename='app.log',
-    level=logging.DEBUG,
-    format='%(asctime)s %(levelname)s: %(message)s'
-)
-
-# Prompt Template
-INSIGHT_PROMPT_TEMPLATE = """
-You are a helpful financial analyst. Given the ticker {ticker} and the following data,
-produce a concise investment analysis (3–6 short paragraphs) covering:
-- recent price action summary
-- key fundamental metrics (PE, beta)
-- risk considerations
-- investment thesis and recommended time horizon
-
-Raw data:
-{raw_summary}
-"""
+# Prompt Template (an f-string compiles once at import, so rendering skips format-string parsing).
+# The persona lives in the system message; keep this short, since prompt size adds latency.
+def render_insight_prompt(ticker: str, raw_summary: str) -> str:
+    return (
+        f"Analyze {ticker} in 3-6 short paragraphs: price action, P/E and beta, "
+        f"risks, investment thesis and time horizon.\n{raw_summary}"
+    )
 
 # API Configuration
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+FULL_MODEL = "gpt-4o"        # complete fundamentals to reason over
+LIGHT_MODEL = "gpt-4o-mini"  # sparse data, where the larger model adds only latency
 USE_DSPY = False
 
-logging.info(f"OPENAI_API_KEY configured: {bool(OPENAI_API_KEY)}")
+logging.info("OPENAI_API_KEY configured: %s", bool(OPENAI_API_KEY))
 if OPENAI_API_KEY:
-    logging.info(f"API Key starts with: {OPENAI_API_KEY[:10]}...")
+    logging.info("API Key starts with: %s...", OPENAI_API_KEY[:10])
+
+@lru_cache(maxsize=None)
+def _get_lm(model: str):
+    """
+    Returns the DSPy language model for the given OpenAI model name, building it only once per process.
+    """
+    return dspy.LM(model=f"openai/{model}", api_key=OPENAI_API_KEY, max_tokens=400)
+
+def _select_model(stock_data: Dict) -> str:
+    """
+    Routes tickers with missing fundamentals to the lighter, faster model.
+    """
+    if any(stock_data.get(k) in (None, "N/A") for k in ("pe_ratio", "beta")):
+        return LIGHT_MODEL
+    return FULL_MODEL
 
 # Initialize DSPy model
 try:
-    lm = dspy.LM(model="openai/gpt-4", api_key=OPENAI_API_KEY)
-    dspy.configure(lm=lm)
+    dspy.configure(lm=_get_lm(FULL_MODEL))
     USE_DSPY = True
     logging.info("DSPy initialized successfully")
 except Exception as e:
     USE_DSPY = False
-    logging.warning(f"DSPy initialization failed: {e}")
+    logging.warning("DSPy initialization failed: %s", e)
+
+# Recently generated insights, keyed on the ticker and the metrics fed to the prompt
+_INSIGHT_CACHE = TTLCache(maxsize=512, ttl=300)
+_INSIGHT_CACHE_LOCK = Lock()
 
-# Initialize OpenAI client (fallback option)
+# Initialize OpenAI client (fallback option). A shared HTTP/2 connection pool lets
+# concurrent requests reuse TCP+TLS connections instead of handshaking per call.
+_http_client = httpx.Client(
+    http2=True,
+    timeout=30.0,
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+)
 try:
-    client = OpenAI(api_key=OPENAI_API_KEY)
+    client = OpenAI(api_key=OPENAI_API_KEY, http_client=_http_client)
     logging.info("OpenAI client initialized successfully")
 except Exception as e:
     client = None
-    logging.error(f"OpenAI client initialization failed: {e}")
+    logging.error("OpenAI client initialization failed: %s", e)
 
 # ---------------------------------------------------------------------
 #  Task 4: Implement Financial Insight Generation using DSPy
@@ -67,63 +86,217 @@ class FinancialInsight(dspy.Signature):
     raw_summary = dspy.InputField(desc="Structured summary of key company data")
     analysis = dspy.OutputField(desc="A concise investment analysis (3-6 short paragraphs)")
 
+# Built once and shared; the LM is chosen per call with dspy.context
+_PREDICTOR = dspy.Predict(FinancialInsight)
+
+def _insight_cache_key(ticker: str, raw_data: Dict) -> tuple:
+    """
+    Builds the insight cache key, rounding float metrics so tick-level noise still hits the cache.
+    """
+    return (ticker,) + tuple(round(v, 2) if isinstance(v, float) else v for v in raw_data.values())
+
+def _remember_insight(cache_key: tuple, insight: str) -> str:
+    with _INSIGHT_CACHE_LOCK:
+        _INSIGHT_CACHE[cache_key] = insight
+    return insight
+
+def _prepare_insight(ticker: str, stock_data: Dict):
+    """
+    Returns the cache key and the raw data summary for an insight request.
+    """
+    raw_data = {
+        "company": stock_data.get("company"),
+        "sector": stock_data.get("sector"),
+        "price": stock_data.get("price"),
+        "change_pct": stock_data.get("change_pct"),
+        "pe_ratio": stock_data.get("pe_ratio"),
+        "beta": stock_data.get("beta"),
+    }
+    raw_summary = "\n".join([f"{k}: {v}" for k, v in raw_data.items()])
+    return _insight_cache_key(ticker, raw_data), raw_summary
+
+def _cached_insight(cache_key: tuple):
+    with _INSIGHT_CACHE_LOCK:
+        return _INSIGHT_CACHE.get(cache_key)
+
+def _dspy_insight(ticker: str, raw_summary: str, model: str):
+    """
+    Runs the DSPy predictor, returning None when it fails so callers can fall back.
+    """
+    try:
+        logging.info("Attempting DSPy-based analysis with %s...", model)
+        with dspy.context(lm=_get_lm(model)):
+            result = _PREDICTOR(ticker=ticker, raw_summary=raw_summary)
+        logging.info("DSPy analysis successful")
+        return result.analysis
+    except Exception as e:
+        logging.error("DSPy analysis failed: %s", e, exc_info=True)
+        return None
+
+def _chat_request(ticker: str, raw_summary: str, model: str) -> Dict:
+    """
+    Keyword arguments for the OpenAI chat completion used by the fallback path.
+    """
+    return dict(
+        model=model,
+        messages=[
+            {"role": "system", "content": "You are a helpful financial analyst."},
+            {"role": "user", "content": render_insight_prompt(ticker, raw_summary)},
+        ],
+        temperature=0.2,
+        max_tokens=400,
+    )
+
+def _heuristic_insight(ticker: str, stock_data: Dict) -> str:
+    return (
+        f"Analysis for {ticker}:\n"
+        f"Price: {stock_data.get('price')}\n"
+        f"P/E Ratio: {stock_data.get('pe_ratio')}\n"
+        f"Beta: {stock_data.get('beta')}\n\n"
+        f"(Insight generation service unavailable. "
+        f"Please verify your OPENAI_API_KEY and DSPy setup.)"
+    )
+
+def _start_insight(ticker: str, stock_data: Dict):
+    """
+    First step shared by every entry point: builds the prompt inputs, picks the model and
+    checks the cache. Returns (cache_key, raw_summary, model, cached insight or None).
+    """
+    cache_key, raw_summary = _prepare_insight(ticker, stock_data)
+    model = _select_model(stock_data)
+    cached = _cached_insight(cache_key)
+    if cached is not None:
+        logging.info("Serving cached insight for %s", ticker)
+    else:
+        logging.info("Generating insight for %s with %s (USE_DSPY=%s, client=%s)", ticker, model, USE_DSPY, client is not None)
+    return cache_key, raw_summary, model, cached
+
+def _openai_available() -> bool:
+    if client and OPENAI_API_KEY:
+        return True
+    logging.warning("OpenAI client not available (client=%s, key=%s)", client is not None, bool(OPENAI_API_KEY))
+    return False
+
+def _complete_insight(ticker: str, stock_data: Dict, cache_key: tuple, raw_summary: str, model: str,
+                      try_openai: bool = True) -> str:
+    """
+    The blocking fallback chain: DSPy, then an OpenAI completion, then the heuristic text.
+    AI-generated insights are cached.
+    """
+    # Option 1: DSPy-based Analysis (Preferred)
+    if USE_DSPY:
+        insight = _dspy_insight(ticker, raw_summary, model)
+        if insight is not None:
+            return _remember_insight(cache_key, insight)
+
+    # Option 2: OpenAI Fallback, over the shared connection pool
+    if try_openai and _openai_available():
+        try:
+            logging.info("Attempting OpenAI fallback...")
+            response = client.chat.completions.create(**_chat_request(ticker, raw_summary, model))
+            logging.info("OpenAI analysis successful")
+            return _remember_insight(cache_key, response.choices[0].message.content.strip())
+        except Exception as e:
+            logging.error("OpenAI fallback failed: %s", e, exc_info=True)
+
+    # Option 3: Heuristic Fallback (No AI available)
+    return _heuristic_insight(ticker, stock_data)
+
 def dsp_financial_insight(ticker: str, stock_data: Dict) -> str:
+    """
+    Generates the insight for one ticker, blocking until it is complete.
+    """
     try:
-        raw_data = {
-            "company": stock_data.get("company"),
-            "sector": stock_data.get("sector"),
-            "price": stock_data.get("price"),
-            "change_pct": stock_data.get("change_pct"),
-            "pe_ratio": stock_data.get("pe_ratio"),
-            "beta": stock_data.get("beta"),
-        }
-        raw_summary = "\n".join([f"{k}: {v}" for k, v in raw_data.items()])
-        prompt = INSIGHT_PROMPT_TEMPLATE.format(ticker=ticker, raw_summary=raw_summary)
-
-        logging.info(f"Generating insight for {ticker} (USE_DSPY={USE_DSPY}, client={client is not None})")
-
-        # Option 1: DSPy-based Analysis (Preferred)
-        if USE_DSPY:
-            try:
-                logging.info("Attempting DSPy-based analysis...")
-                predictor = dspy.Predict("input_text -> analysis_text", llm=lm)
-                result = predictor(input_text=prompt)
-                logging.info("DSPy analysis successful")
-                return getattr(result, "analysis_text", str(result))
-            except Exception as e:
-                logging.error(f"DSPy analysis failed: {e}")
-                traceback.print_exc()
-
-        # Option 2: OpenAI Fallback
-        if client and OPENAI_API_KEY:
-            try:
-                logging.info("Attempting OpenAI fallback...")
-                response = client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[
-                        {"role": "system", "content": "You are a helpful financial analyst."},
-                        {"role": "user", "content": prompt},
-                    ],
-                    temperature=0.2,
-                    max_tokens=700,
-                )
-                logging.info("OpenAI analysis successful")
-                return response.choices[0].message.content.strip()
-            except Exception as e:
-                logging.error(f"OpenAI fallback failed: {e}")
-                traceback.print_exc()
-        else:
-            logging.warning(f"OpenAI client not available (client={client is not None}, key={bool(OPENAI_API_KEY)})")
-        # Option 3: Heuristic Fallback (No AI available)
-        heuristic_text = (
-            f"Analysis for {ticker}:\n"
-            f"Price: {stock_data.get('price')}\n"
-            f"P/E Ratio: {stock_data.get('pe_ratio')}\n"
-            f"Beta: {stock_data.get('beta')}\n\n"
-            f"(Insight generation service unavailable. "
-            f"Please verify your OPENAI_API_KEY and DSPy setup.)"
-        )
-        return heuristic_text
+        cache_key, raw_summary, model, cached = _start_insight(ticker, stock_data)
+        if cached is not None:
+            return cached
+        return _complete_insight(ticker, stock_data, cache_key, raw_summary, model)
     except Exception as e:
-        traceback.print_exc()
-        return f"Failed to generate insight: {e}"
\ No newline at end of file
+        logging.exception("Insight generation failed for %s", ticker)
+        return f"Failed to generate insight: {e}"
+
+class InsightStreamError(RuntimeError):
+    """
+    Raised by stream_financial_insight when generation fails after text was already yielded.
+    """
+
+def stream_financial_insight(ticker: str, stock_data: Dict) -> Iterator[str]:
+    """
+    Yields the insight in chunks as the model produces them, so the first words reach the
+    browser long before the full completion is done. The complete text is cached on success.
+    Raises InsightStreamError if the stream breaks part-way; the partial text must be discarded.
+    """
+    cache_key, raw_summary, model, cached = _start_insight(ticker, stock_data)
+    if cached is not None:
+        yield cached
+        return
+
+    # Option 1: Streamed OpenAI completion (DSPy returns the whole prediction at once)
+    if _openai_available():
+        parts = []
+        try:
+            logging.info("Attempting streamed OpenAI analysis...")
+            for chunk in client.chat.completions.create(**_chat_request(ticker, raw_summary, model), stream=True):
+                if not chunk.choices:
+                    continue
+                text = chunk.choices[0].delta.content
+                if text:
+                    parts.append(text)
+                    yield text
+        except Exception as e:
+            logging.error("Streamed OpenAI analysis failed: %s", e, exc_info=True)
+            if parts:
+                # The client already holds a truncated insight; it cannot be completed or replaced
+                raise InsightStreamError(f"Insight stream for {ticker} was interrupted") from e
+        else:
+            logging.info("Streamed OpenAI analysis successful")
+            _remember_insight(cache_key, "".join(parts).strip())
+            return
+
+    # Options 2 and 3: DSPy or the heuristic text, delivered as a single chunk
+    yield _complete_insight(ticker, stock_data, cache_key, raw_summary, model, try_openai=False)
+
+def analyze_many(stock_data_by_ticker: Dict[str, Dict], poll_interval: float = 30.0) -> Dict[str, str]:
+    """
+    Generates insights for many tickers through the OpenAI Batch API, which bills at half price.
+    Blocks until the batch finishes (up to its 24h window), so use it for background jobs only.
+    """
+    if not (client and OPENAI_API_KEY):
+        raise RuntimeError("OpenAI client not available for batch analysis")
+
+    lines = []
+    for ticker, stock_data in stock_data_by_ticker.items():
+        _, raw_summary = _prepare_insight(ticker, stock_data)
+        lines.append(json.dumps({
+            "custom_id": ticker,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": _chat_request(ticker, raw_summary, _select_model(stock_data)),
+        }))
+
+    batch_file = client.files.create(file=("insights.jsonl", "\n".join(lines).encode()), purpose="batch")
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    logging.info("Submitted batch %s for %s tickers", batch.id, len(lines))
+
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(poll_interval)
+        batch = client.batches.retrieve(batch.id)
+
+    if batch.status != "completed" or not batch.output_file_id:
+        raise RuntimeError(f"Batch {batch.id} finished with status {batch.status}")
+
+    insights = {}
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        record = json.loads(line)
+        response = record.get("response") or {}
+        if response.get("status_code") != 200:
+            logging.error("Batch analysis failed for %s: %s", record.get('custom_id'), record.get('error'))
+            continue
+        insights[record["custom_id"]] = response["body"]["choices"][0]["message"]["content"].strip()
+
+    logging.info("Batch %s completed with %s insights", batch.id, len(insights))
+    return insights
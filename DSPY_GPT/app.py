@@ -1,122 +1,401 @@
+import atexit
+import hashlib
+import logging
+import math
 import os
-import traceback
-import markdown
+import queue
+import secrets
+import sqlite3
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
+from logging.handlers import QueueHandler, QueueListener, WatchedFileHandler
 from datetime import datetime, UTC
-from flask import Flask, render_template, request, jsonify, send_file, session
+from threading import Thread
+from cachetools.func import ttl_cache
+import click
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine, make_url
+from markdown_it import MarkdownIt
+from flask.json.provider import DefaultJSONProvider
+from flask import Flask, Response, abort, render_template, request, jsonify, session, stream_with_context
 from dotenv import load_dotenv
+import numpy as np
+import orjson
 import pandas as pd
+from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+# ---------------------------------------------------------------------
+# Logging Configuration (before local imports, so their import-time logs are kept)
+# ---------------------------------------------------------------------
+# Request threads only enqueue records; a background listener thread does the
+# formatting and I/O. force=True replaces any handler a library attached to the
+# root logger during its own import.
+# LOG_FILE (default app.log) is appended to by every worker process, so it is never
+# rotated in-process; WatchedFileHandler reopens it after an external logrotate.
+# An empty LOG_FILE logs to stderr, which gunicorn.conf.py selects by default.
+load_dotenv()
+LOG_FILE = os.getenv("LOG_FILE", "app.log")
+_log_handler = WatchedFileHandler(LOG_FILE) if LOG_FILE else logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+_log_queue = queue.SimpleQueue()
+_log_listener = QueueListener(_log_queue, _log_handler)
+_log_queue_handler = QueueHandler(_log_queue)
+_log_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.DEBUG, handlers=[_log_queue_handler], force=True)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 
 # ---------------------------------------------------------------------
 # Tasks 2, 3, and 4: Add Local Imports
 # ---------------------------------------------------------------------
-from extensions import db
+from extensions import cache, compress, db
 from models import Holding, AnalysisHistory
-from utils import get_stock_data
-from ai_module import dsp_financial_insight
+from utils import get_stock_data, get_stock_data_bulk, history_to_json
+from ai_module import dsp_financial_insight, stream_financial_insight, analyze_many
 
 # ---------------------------------------------------------------------
-# Environment Configuration
+# Environment Configuration (.env was loaded with the logging setup above)
 # ---------------------------------------------------------------------
-load_dotenv()
 
 OPENAI_KEY = os.getenv("OPENAI_API_KEY")
 SECRET_KEY = os.getenv("SECRET_KEY", "CHANGE_THIS_TO_A_RANDOM_VALUE")
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///finance.db")
 PORT = int(os.getenv("PORT", 5000))
 DEBUG_MODE = os.getenv("FLASK_ENV") == "development"
+REDIS_URL = os.getenv("REDIS_URL")
+
+# ---------------------------------------------------------------------
+# Database Engine Tuning
+# ---------------------------------------------------------------------
+def _engine_options(database_url):
+    """
+    Pool settings per backend. In-memory SQLite keeps Flask-SQLAlchemy's StaticPool.
+    """
+    url = make_url(database_url)
+    if url.get_backend_name() == "sqlite":
+        if url.database in (None, "", ":memory:"):
+            return {}
+        return {
+            "pool_size": 20,
+            "max_overflow": 10,
+            "connect_args": {"check_same_thread": False, "timeout": 30},
+        }
+    return {"pool_size": 25, "max_overflow": 10, "pool_pre_ping": True, "pool_recycle": 1800}
+
+
+@event.listens_for(Engine, "connect")
+def _tune_sqlite(dbapi_connection, connection_record):
+    # WAL lets readers run alongside the single writer; the rest trades a little
+    # durability on power loss for far fewer fsyncs and page reads.
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.close()
 
 # ---------------------------------------------------------------------
 # Flask Application Setup
 # ---------------------------------------------------------------------
-import logging
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    JSON provider backed by orjson; types it doesn't know fall back to Flask's default hook.
+    """
+    option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
-# Configure logging to file
-logging.basicConfig(
-    filename='app.log',
-    level=logging.DEBUG,
-    format='%(asctime)s %(levelname)s: %(message)s'
-)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config.update(
     SECRET_KEY=SECRET_KEY,
     SQLALCHEMY_DATABASE_URI=DATABASE_URL,
+    SQLALCHEMY_ENGINE_OPTIONS=_engine_options(DATABASE_URL),
     SQLALCHEMY_TRACK_MODIFICATIONS=False,
+    # SSE responses must reach the client as they are produced, not compressed as one body
+    COMPRESS_STREAMS=False,
+    MAX_CONTENT_LENGTH=64 * 1024,
 )
+if REDIS_URL:
+    app.config.update(CACHE_TYPE="RedisCache", CACHE_REDIS_URL=REDIS_URL)
+else:
+    app.config.update(
+        CACHE_TYPE="FileSystemCache",
+        CACHE_DIR=os.path.join(app.instance_path, "cache"),
+    )
 
 
 db.init_app(app)
+cache.init_app(app)
+compress.init_app(app)
 
-# Ensure tables exist
+# Bounded pool for PDF rendering: caps concurrent reportlab work and lets a
+# request give up after REPORT_TIMEOUT seconds instead of hanging its worker
+REPORT_EXECUTOR = ThreadPoolExecutor(max_workers=8)
+REPORT_TIMEOUT = 30
+
+# Shared pool for blocking yfinance lookups; the calls are network-bound so
+# threads overlap their round-trips and page latency tracks the slowest ticker
+QUOTE_EXECUTOR = ThreadPoolExecutor(max_workers=16)
+
+# Pay yfinance's lazy imports and Yahoo cookie/crumb handshake at boot, in the
+# background, rather than inside the first request. yfinance keeps that session
+# process-wide, so later lookups reuse it.
+if not DEBUG_MODE and os.getenv("YF_WARMUP", "1") == "1":
+    QUOTE_EXECUTOR.submit(get_stock_data, "AAPL")
+
+def _pending_schema_upgrades(conn):
+    """
+    Returns the names of the upgrades an existing analysis_history table still needs.
+    """
+    inspector = db.inspect(conn)
+    columns = {c["name"]: c for c in inspector.get_columns("analysis_history")}
+    index_names = {i["name"] for i in inspector.get_indexes("analysis_history")}
+
+    pending = []
+    if "analysis_html" not in columns:
+        pending.append("analysis_html")
+    # created_at used to be stamped in Python; it now relies on the database default
+    if columns["created_at"]["default"] is None:
+        pending.append("created_at_default")
+    if any(index.name not in index_names for index in AnalysisHistory.__table__.indexes):
+        pending.append("indexes")
+    return pending
+
+
+def _rebuild_sqlite_history(conn):
+    """
+    Recreates analysis_history from the model, keeping its rows. SQLite cannot alter a
+    column default in place. Must run inside upgrade_schema's transaction, so a failure
+    part-way rolls back to the original table.
+    """
+    conn.execute(db.text("DROP INDEX IF EXISTS ix_analysis_history_created_at"))
+    conn.execute(db.text("ALTER TABLE analysis_history RENAME TO analysis_history_old"))
+    AnalysisHistory.__table__.create(conn)
+    conn.execute(db.text(
+        "INSERT INTO analysis_history (id, ticker, analysis, analysis_html, created_at) "
+        "SELECT id, ticker, analysis, analysis_html, created_at FROM analysis_history_old"
+    ))
+    conn.execute(db.text("DROP TABLE analysis_history_old"))
+
+
+def _apply_schema_upgrades(conn):
+    pending = _pending_schema_upgrades(conn)
+    if "analysis_html" in pending:
+        conn.execute(db.text("ALTER TABLE analysis_history ADD COLUMN analysis_html TEXT"))
+
+    if "created_at_default" in pending:
+        if conn.dialect.name == "sqlite":
+            _rebuild_sqlite_history(conn)
+        else:
+            conn.execute(db.text(
+                "ALTER TABLE analysis_history ALTER COLUMN created_at SET DEFAULT CURRENT_TIMESTAMP"
+            ))
+
+    # Indexes declared on the models after the table already existed
+    for index in AnalysisHistory.__table__.indexes:
+        index.create(conn, checkfirst=True)
+    return pending
+
+
+def upgrade_schema(engine):
+    """
+    Adds columns, defaults and indexes introduced after the tables were first created
+    (create_all only creates missing tables). Everything runs in one transaction that
+    concurrent runs wait on and then re-check, so it is safe to repeat.
+    Returns the names of the upgrades applied.
+    """
+    with engine.connect() as conn:
+        if engine.dialect.name != "sqlite":
+            # DDL is transactional on Postgres; the table lock serializes concurrent runs
+            with conn.begin():
+                conn.execute(db.text("LOCK TABLE analysis_history IN ACCESS EXCLUSIVE MODE"))
+                return _apply_schema_upgrades(conn)
+
+        # pysqlite runs DDL outside any transaction unless BEGIN/COMMIT are issued by hand
+        dbapi_conn = conn.connection.driver_connection
+        isolation_level = dbapi_conn.isolation_level
+        dbapi_conn.isolation_level = None
+        try:
+            # IMMEDIATE takes the write lock up front, before the pending upgrades are read
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            try:
+                pending = _apply_schema_upgrades(conn)
+                conn.exec_driver_sql("COMMIT")
+            except BaseException:
+                conn.exec_driver_sql("ROLLBACK")
+                raise
+            return pending
+        finally:
+            dbapi_conn.isolation_level = isolation_level
+
+
+# Ensure tables exist. Upgrading an older database is a separate one-time step
+# (`flask upgrade-db`, run by gunicorn before it starts workers), never a side
+# effect of importing the app in every worker.
 with app.app_context():
     db.create_all()
+    with db.engine.connect() as _conn:
+        _pending = _pending_schema_upgrades(_conn)
+    if _pending:
+        logging.error("Database schema is out of date (%s); run `flask --app app upgrade-db`", ", ".join(_pending))
+
+
+@app.cli.command("upgrade-db")
+def upgrade_db():
+    """
+    Create missing tables and upgrade existing ones to the current models.
+    """
+    db.create_all()
+    applied = upgrade_schema(db.engine)
+    click.echo(f"Applied schema upgrades: {', '.join(applied)}" if applied else "Schema is up to date")
+
+
+# History rows are persisted off the request path: handlers enqueue them and a
+# single writer thread inserts whatever has accumulated in one transaction.
+_HISTORY_QUEUE = queue.Queue()
+HISTORY_BATCH_SIZE = 100
+
+
+def _history_writer():
+    while True:
+        rows = [_HISTORY_QUEUE.get()]
+        while len(rows) < HISTORY_BATCH_SIZE:
+            try:
+                rows.append(_HISTORY_QUEUE.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            with app.app_context():
+                db.session.bulk_insert_mappings(AnalysisHistory, rows)
+                db.session.commit()
+            logging.info("Saved %d analyses to history", len(rows))
+        except Exception as e:
+            logging.error("Failed to save %d analyses to history: %s", len(rows), e)
+        finally:
+            for _ in rows:
+                _HISTORY_QUEUE.task_done()
+
+
+def _save_history(ticker, insight, insight_html):
+    _HISTORY_QUEUE.put({"ticker": ticker, "analysis": insight, "analysis_html": insight_html})
+
+
+Thread(target=_history_writer, name="history-writer", daemon=True).start()
+# Flush pending rows before the interpreter tears the daemon thread down
+atexit.register(_HISTORY_QUEUE.join)
 
 # ---------------------------------------------------------------------
 # Task 5: Flask Frontend Route Implementation for the AI Financial Analyst Assistant
 # ---------------------------------------------------------------------
+DEFAULT_TICKERS = (
+    "AAPL", "MSFT", "GOOG", "AMZN", "META", "TSLA", "NFLX",
+    "JPM", "V", "PG", "NVDA", "ADBE", "CRM", "INTC",
+    "CSCO", "PEP", "COST", "KO", "PFE", "MRK", "UNH",
+    "HD", "WMT", "DIS", "NKE", "BA", "MCD", "SBUX",
+    "IBM", "ORCL", "CMCSA", "T", "VZ", "BABA", "XOM",
+    "CVX", "WFC", "GS", "MS", "AXP", "BAC", "PYPL",
+    "QCOM", "TXN", "AMAT", "GILD", "BIIB", "LMT", "GE",
+)
+
+
+def _fetch_default_stock(ticker):
+    """Fetch one homepage row, falling back to a placeholder on error."""
+    try:
+        return get_stock_data(ticker)
+    except Exception as e:
+        logging.warning("[index] Error fetching %s: %s", ticker, e)
+        return {
+            "ticker": ticker, "company": "N/A", "price": None,
+            "change_pct": None, "pe_ratio": None, "beta": None,
+            "sector": "N/A"
+        }
+
+
 @app.route("/")
+@cache.cached(timeout=30)
 def index():
     """
     Home page displaying live data for default tickers.
+    The rendered page is shared by every visitor for 30 seconds.
     """
-    default_tickers = [
-        "AAPL", "MSFT", "GOOG", "AMZN", "META", "TSLA", "NFLX",
-        "JPM", "V", "PG", "NVDA", "ADBE", "CRM", "INTC",
-        "CSCO", "PEP", "COST", "KO", "PFE", "MRK", "UNH",
-        "HD", "WMT", "DIS", "NKE", "BA", "MCD", "SBUX",
-        "IBM", "ORCL", "CMCSA", "T", "VZ", "BABA", "XOM",
-        "CVX", "WFC", "GS", "MS", "AXP", "BAC", "PYPL",
-        "QCOM", "TXN", "AMAT", "GILD", "BIIB", "LMT", "GE"
-    ]
-
-    stocks = []
-    for ticker in default_tickers:
-        try:
-            stocks.append(get_stock_data(ticker))
-        except Exception as e:
-            print(f"[index] Error fetching {ticker}: {e}")
-            stocks.append({
-                "ticker": ticker, "company": "N/A", "price": None,
-                "change_pct": None, "pe_ratio": None, "beta": None,
-                "sector": "N/A"
-            })
+    # Fan the lookups out over the shared pool; map preserves ticker order
+    stocks = list(QUOTE_EXECUTOR.map(_fetch_default_stock, DEFAULT_TICKERS))
 
     return render_template("index.html", default_stocks=stocks)
 
 
+@ttl_cache(maxsize=256, ttl=60)
+def _cached_quotes(tickers):
+    """
+    Batched quote lookup shared by the portfolio views; repeat views within a minute skip the network.
+    """
+    return get_stock_data_bulk(tickers)
+
+
+def _portfolio_quotes(holdings):
+    """
+    Returns (quotes, ok) for the holdings. A failed lookup raises out of _cached_quotes, so it
+    is never cached; the view shows N/A this time and the next view retries.
+    """
+    try:
+        return _cached_quotes(tuple(h.ticker for h in holdings)), True
+    except Exception as e:
+        logging.warning("Quote lookup failed for %d holdings: %s", len(holdings), e)
+        return {}, False
+
+
+def _holding_values(holdings, quotes):
+    """
+    Prices and rounded position values for each holding as float64 arrays, computed in one
+    vectorized pass. Holdings without a valid (positive) price get NaN in both arrays.
+    """
+    def quote_price(ticker):
+        price = quotes.get(ticker, {}).get("price")
+        return price if isinstance(price, (float, int)) and price > 0 else np.nan
+
+    quantities = np.fromiter((h.quantity for h in holdings), dtype=np.float64, count=len(holdings))
+    prices = np.fromiter((quote_price(h.ticker) for h in holdings), dtype=np.float64, count=len(holdings))
+    return prices, np.round(quantities * prices, 2)
+
+
 @app.route("/portfolio")
 def portfolio_page():
     """
     Display user's portfolio with live prices and total valuation.
     """
     holdings = Holding.query.order_by(Holding.ticker).all()
-    total_value = 0.0
-    enriched = []
-
-    for h in holdings:
-        try:
-            data = get_stock_data(h.ticker)
-        except Exception as e:
-            print(f"[portfolio_page] Error fetching {h.ticker}: {e}")
-            data = {"price": 0.0}
-
-        price = data.get("price") or 0.0
-        value = round(price * h.quantity, 2)
-        total_value += value
+    quotes, _ = _portfolio_quotes(holdings)
+    prices, values = _holding_values(holdings, quotes)
+    prices, values = np.nan_to_num(prices), np.nan_to_num(values)
 
-        enriched.append({
+    enriched = [
+        {
             "id": h.id,
             "ticker": h.ticker,
             "quantity": h.quantity,
             "price": price,
             "value": value,
-        })
+        }
+        for h, price, value in zip(holdings, prices.tolist(), values.tolist())
+    ]
 
-    return render_template("portfolio.html", holdings=enriched, total_value=round(total_value, 2))
+    return render_template("portfolio.html", holdings=enriched, total_value=round(float(values.sum()), 2))
 
 @app.route("/history")
 def history_page():
@@ -129,101 +408,220 @@ def history_page():
 # ---------------------------------------------------------------------
 # Task 6: Implement DSPy Stock Analysis and Insight Summary Routes
 # ---------------------------------------------------------------------
+# Latest analysis per browser session, kept in the shared cache so the signed
+# cookie only carries a short id and any worker can serve the summary page.
+ANALYSIS_TTL = 600
+
+# Insights are rendered to HTML once, when stored, rather than on every summary view
+_MARKDOWN = MarkdownIt("commonmark", {"html": False}).enable("table")
+
+
+def _analysis_id():
+    """
+    Returns the analysis id for the current session, assigning one on first use.
+    """
+    if "aid" not in session:
+        session["aid"] = secrets.token_urlsafe(8)
+    return session["aid"]
+
+
+def _store_analysis(aid, ticker, stock_data, insight, insight_html=None):
+    cache.set(f"analysis:{aid}", {
+        "ticker": ticker,
+        "company": stock_data.get("company", "N/A"),
+        "price": stock_data.get("price", "N/A"),
+        "change_pct": stock_data.get("change_pct", "N/A"),
+        "pe_ratio": stock_data.get("pe_ratio", "N/A"),
+        "beta": stock_data.get("beta", "N/A"),
+        "insight": insight,
+        "insight_html": insight_html if insight_html is not None else _MARKDOWN.render(insight),
+    }, timeout=ANALYSIS_TTL)
+
+
+# API payloads are a ticker and maybe a quantity; anything larger is rejected unread
+API_BODY_LIMIT = 4096
+
+
+def _json_body():
+    """
+    Returns the request's JSON object, or {} when the body is missing or not a JSON object.
+    Aborts with 413 when the declared body exceeds API_BODY_LIMIT.
+    """
+    if (request.content_length or 0) > API_BODY_LIMIT:
+        abort(413)
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else {}
+
+
 @app.route("/api/analyze", methods=["POST"])
 def api_analyze():
     """
     Analyze a stock using DSPy and return financial insights.
     """
+    data = _json_body()
     try:
-        data = request.get_json(force=True)
         ticker = data.get("ticker", "").strip().upper()
 
         if not ticker:
             return jsonify({"error": "Ticker required"}), 400
 
-        logging.info(f"Analyzing ticker: {ticker}")
+        logging.info("Analyzing ticker: %s", ticker)
         try:
-            stock_data = get_stock_data(ticker)
+            # The analyze response is the only one that returns the 30-day history
+            stock_data = get_stock_data(ticker, include_history=True)
         except Exception as sd_e:
-            logging.error(f"get_stock_data failed: {sd_e}")
+            logging.error("get_stock_data failed: %s", sd_e)
             raise sd_e
 
-        logging.info(f"Stock data fetched: {stock_data.keys() if stock_data else 'None'}")
+        logging.debug("Stock data fetched: %s", stock_data.keys() if stock_data else None)
         if not stock_data:
             return jsonify({"error": f"No data found for {ticker}"}), 404
 
         # Generate DSPy insight
         insight = dsp_financial_insight(ticker, stock_data)
+        insight_html = _MARKDOWN.render(insight)
 
-        # Save to database for history
-        try:
-            history_record = AnalysisHistory(
-                ticker=ticker,
-                analysis=insight
-            )
-            db.session.add(history_record)
-            db.session.commit()
-            logging.info(f"Analysis saved to history for {ticker}")
-        except Exception as db_error:
-            logging.error(f"Failed to save analysis to history: {db_error}")
-            # Don't fail the request if history save fails
-
-        # Store in session for summary page
-        session["latest_insight"] = {
-            "ticker": ticker,
-            "company": stock_data.get("company", "N/A"),
-            "price": stock_data.get("price", "N/A"),
-            "change_pct": stock_data.get("change_pct", "N/A"),
-            "pe_ratio": stock_data.get("pe_ratio", "N/A"),
-            "beta": stock_data.get("beta", "N/A"),
-            "insight": insight
-        }
+        # Queue for the history writer; a failed save never fails the request
+        _save_history(ticker, insight, insight_html)
+
+        # Store server-side for the summary page
+        _store_analysis(_analysis_id(), ticker, stock_data, insight, insight_html)
 
-        return jsonify({"status": "ok", "stock": stock_data, "insight": insight})
+        stock_json = {**stock_data, "history": history_to_json(stock_data["history"])}
+        return jsonify({"status": "ok", "stock": stock_json, "insight": insight})
 
     except Exception as e:
-        logging.error(f"API Analysis Failed: {e}", exc_info=True)
-        traceback.print_exc()
+        logging.error("API Analysis Failed: %s", e, exc_info=True)
         return jsonify({"error": str(e)}), 500
 
 
+def _sse(data, event=None):
+    """
+    Formats one Server-Sent Events message; payloads are JSON so newlines survive framing.
+    """
+    message = f"data: {app.json.dumps(data)}\n\n"
+    return f"event: {event}\n{message}" if event else message
+
+
+@app.route("/api/analyze/stream")
+def api_analyze_stream():
+    """
+    Stream a DSPy/OpenAI insight for a stock as Server-Sent Events.
+    """
+    ticker = request.args.get("ticker", "").strip().upper()
+    if not ticker:
+        return jsonify({"error": "Ticker required"}), 400
+
+    try:
+        stock_data = get_stock_data(ticker)
+    except Exception as e:
+        logging.error("get_stock_data failed: %s", e, exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
+    if not stock_data:
+        return jsonify({"error": f"No data found for {ticker}"}), 404
+
+    # Assign the id now: the session cookie goes out with the headers, before the body streams
+    aid = _analysis_id()
+
+    def generate():
+        yield _sse(stock_data, event="stock")
+
+        parts = []
+        try:
+            for text in stream_financial_insight(ticker, stock_data):
+                parts.append(text)
+                yield _sse({"text": text})
+        except Exception as e:
+            # Nothing is cached or saved; a partial insight must not look like a finished one
+            logging.error("Streamed analysis failed for %s: %s", ticker, e)
+            yield _sse({"error": "Analysis failed, please retry"}, event="error")
+            return
+
+        insight = "".join(parts)
+        insight_html = _MARKDOWN.render(insight)
+        _store_analysis(aid, ticker, stock_data, insight, insight_html)
+        _save_history(ticker, insight, insight_html)
+
+        yield _sse({"ticker": ticker}, event="done")
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.route("/insight_summary")
 def insight_summary():
-    insight_data = session.get("latest_insight")
+    aid = session.get("aid")
+    insight_data = cache.get(f"analysis:{aid}") if aid else None
     if not insight_data:
         return render_template("error.html", message="No DSPy insight found. Please analyze a stock first.")
-    formatted_text = markdown.markdown(insight_data["insight"])
-    insight_data["insight"] = formatted_text
     return render_template("insight_summary.html", insight=insight_data)
 
+@app.cli.command("backfill-analyses")
+@click.argument("tickers", nargs=-1, required=True)
+def backfill_analyses(tickers):
+    """
+    Analyze TICKERS through the OpenAI Batch API and save the results to history.
+    """
+    tickers = dict.fromkeys(t.strip().upper() for t in tickers)
+    stock_data = {ticker: get_stock_data(ticker) for ticker in tickers}
+
+    try:
+        insights = analyze_many(stock_data)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    for ticker, insight in insights.items():
+        db.session.add(AnalysisHistory(ticker=ticker, analysis=insight, analysis_html=_MARKDOWN.render(insight)))
+    db.session.commit()
+    click.echo(f"Saved {len(insights)} of {len(stock_data)} analyses to history")
+
 # ---------------------------------------------------------------------
 # Task 7: Implement Portfolio Management Routes
 # ---------------------------------------------------------------------
+# Backends with INSERT ... ON CONFLICT DO UPDATE ... RETURNING; others fall back to read-then-write
+_UPSERT_INSERTS = {"postgresql": postgresql_insert, "sqlite": sqlite_insert}
+
+
 @app.route("/api/portfolio", methods=["POST"])
 def portfolio_api():
     """
     Add or update holdings in the portfolio.
     """
+    data = _json_body()
     try:
-        data = request.get_json(force=True)
         ticker = data.get("ticker", "").strip().upper()
         qty = float(data.get("quantity", 0))
 
         if not ticker or qty <= 0:
             return jsonify({"error": "Valid ticker and positive quantity required"}), 400
 
-        holding = Holding.query.filter_by(ticker=ticker).first()
-        if holding:
-            holding.quantity += qty
+        insert = _UPSERT_INSERTS.get(db.engine.dialect.name)
+        if insert is not None:
+            # Single-statement upsert: insert the holding or add to its existing quantity
+            stmt = insert(Holding).values(ticker=ticker, quantity=qty)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[Holding.ticker],
+                set_={"quantity": Holding.quantity + stmt.excluded.quantity},
+            ).returning(Holding.quantity)
+            quantity = db.session.execute(stmt).scalar_one()
         else:
-            holding = Holding(ticker=ticker, quantity=qty)
-            db.session.add(holding)
-
+            # Other backends: read, then update or insert
+            holding = Holding.query.filter_by(ticker=ticker).first()
+            if holding:
+                holding.quantity += qty
+            else:
+                holding = Holding(ticker=ticker, quantity=qty)
+                db.session.add(holding)
+            db.session.flush()
+            quantity = holding.quantity
         db.session.commit()
-        return jsonify({"ok": True, "ticker": ticker, "quantity": holding.quantity})
+        return jsonify({"ok": True, "ticker": ticker, "quantity": quantity})
 
     except Exception as e:
-        traceback.print_exc()
+        logging.exception("Failed to update portfolio")
         return jsonify({"error": "Failed to update portfolio", "details": str(e)}), 500
 
 
@@ -232,28 +630,68 @@ def portfolio_delete():
     """
     Delete a holding from the user's portfolio.
     """
+    data = _json_body()
     try:
-        data = request.get_json(force=True)
         ticker = data.get("ticker", "").strip().upper()
 
         if not ticker:
             return jsonify({"error": "Ticker required"}), 400
 
-        holding = Holding.query.filter_by(ticker=ticker).first()
-        if not holding:
-            return jsonify({"error": f"No record found for {ticker}"}), 404
-
-        db.session.delete(holding)
+        # Single DELETE; the affected row count tells us whether it existed
+        result = db.session.execute(db.delete(Holding).where(Holding.ticker == ticker))
         db.session.commit()
+        if result.rowcount == 0:
+            return jsonify({"error": f"No record found for {ticker}"}), 404
         return jsonify({"ok": True})
 
     except Exception as e:
-        traceback.print_exc()
+        logging.exception("Failed to delete holding")
         return jsonify({"error": "Failed to delete", "details": str(e)}), 500
 
 # ---------------------------------------------------------------------
 # Task 8: Implement Portfolio PDF Report Generation Route
 # ---------------------------------------------------------------------
+# Report layout is built once at import; per-request work is only the table rows
+_REPORT_STYLES = getSampleStyleSheet()
+_REPORT_TABLE_STYLE = TableStyle([
+    ("FONT", (0, 0), (-1, 0), "Helvetica-Bold", 11),
+    ("FONT", (0, 1), (-1, -1), "Helvetica", 10),
+    ("LINEBELOW", (0, 0), (-1, 0), 0.75, colors.black),
+    ("ALIGN", (1, 0), (-1, -1), "RIGHT"),
+    ("BOTTOMPADDING", (0, 0), (-1, -1), 4),
+])
+
+# Rendered reports are content-addressed by (holdings snapshot, minute) in the
+# shared cache, so refreshes and retries on any worker skip the work
+REPORT_CACHE_TTL = 60
+
+
+def _build_portfolio_pdf(items, total_value):
+    """
+    Renders the pre-formatted portfolio report rows into PDF bytes.
+    """
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(
+        buffer, pagesize=letter, leftMargin=40, rightMargin=40, topMargin=40, bottomMargin=60,
+        title="Portfolio Report",
+    )
+    table = Table(
+        [("Ticker", "Quantity", "Price", "Value")] + items,
+        colWidths=[100, 100, 100, 100],
+        hAlign="LEFT",
+        repeatRows=1,
+        style=_REPORT_TABLE_STYLE,
+    )
+    doc.build([
+        Paragraph("Financial Analyst Assistant - Portfolio Report", _REPORT_STYLES["Heading2"]),
+        Paragraph(f"Generated: {datetime.now(UTC):%Y-%m-%d %H:%M:%S UTC}", _REPORT_STYLES["Normal"]),
+        Paragraph(f"Total Value: ${total_value:,.2f}", _REPORT_STYLES["Normal"]),
+        Spacer(1, 18),
+        table,
+    ])
+    return buffer.getvalue()
+
+
 @app.route("/report/portfolio.pdf")
 def portfolio_report():
     """
@@ -262,70 +700,62 @@ def portfolio_report():
     """
     try:
         holdings = Holding.query.order_by(Holding.ticker).all()
-        total_value = 0.0
-        items = []
-
-        for h in holdings:
-            try:
-                data = get_stock_data(h.ticker)
-            except Exception as e:
-                print(f"[portfolio_report] Error fetching {h.ticker}: {e}")
-                data = {"price": None}
-
-            price = data.get("price")
-            qty = h.quantity
-            is_valid_price = isinstance(price, (float, int)) and price > 0
-
-            if is_valid_price:
-                value = round(price * qty, 2)
-                total_value += value
-                price_display = f"${price:,.2f}"
-                value_display = f"${value:,.2f}"
+        snapshot = repr((sorted((h.ticker, h.quantity) for h in holdings), int(time.time() // 60)))
+        digest = hashlib.blake2b(snapshot.encode(), digest_size=16).hexdigest()
+        headers = {"Cache-Control": f"private, max-age={REPORT_CACHE_TTL}", "ETag": f'W/"{digest}"'}
+
+        # The browser already holds this exact report
+        if request.if_none_match.contains_weak(digest):
+            return Response(status=304, headers=headers)
+
+        pdf = cache.get(f"pdf:{digest}")
+
+        if pdf is None:
+            quotes, quotes_ok = _portfolio_quotes(holdings)
+            prices, values = _holding_values(holdings, quotes)
+            total_value = float(np.nansum(values))
+            # Rows are formatted up front so the layout pass only measures strings
+            items = [
+                (h.ticker, str(h.quantity), "N/A", "N/A") if math.isnan(price)
+                else (h.ticker, str(h.quantity), f"${price:,.2f}", f"${value:,.2f}")
+                for h, price, value in zip(holdings, prices.tolist(), values.tolist())
+            ]
+
+            # PDF generation
+            pdf = REPORT_EXECUTOR.submit(_build_portfolio_pdf, items, total_value).result(timeout=REPORT_TIMEOUT)
+            if quotes_ok:
+                cache.set(f"pdf:{digest}", pdf, timeout=REPORT_CACHE_TTL)
             else:
-                price_display = "N/A"
-                value_display = "N/A"
-
-            items.append((h.ticker, qty, price_display, value_display))
-
-        # PDF generation
-        buffer = BytesIO()
-        c = canvas.Canvas(buffer, pagesize=letter)
-        width, height = letter
-
-        c.setFont("Helvetica-Bold", 16)
-        c.drawString(40, height - 40, "Financial Analyst Assistant - Portfolio Report")
-        c.setFont("Helvetica", 10)
-        c.drawString(40, height - 60, f"Generated: {datetime.now(UTC):%Y-%m-%d %H:%M:%S UTC}")
-        c.drawString(40, height - 75, f"Total Value: ${total_value:,.2f}")
-
-        y = height - 110
-        c.setFont("Helvetica-Bold", 11)
-        c.drawString(40, y, "Ticker")
-        c.drawString(140, y, "Quantity")
-        c.drawString(240, y, "Price")
-        c.drawString(340, y, "Value")
-
-        y -= 18
-        c.setFont("Helvetica", 10)
-        for t, q, p_display, v_display in items:
-            if y < 80:
-                c.showPage()
-                y = height - 60
-            c.drawString(40, y, str(t))
-            c.drawString(140, y, str(q))
-            c.drawString(240, y, str(p_display))
-            c.drawString(340, y, str(v_display))
-            y -= 16
-
-        c.showPage()
-        c.save()
-        buffer.seek(0)
-        return send_file(buffer, mimetype="application/pdf", as_attachment=True, download_name="portfolio_report.pdf")
-
+                # A report with missing prices must not be reused by us or the browser
+                headers = {"Cache-Control": "no-store"}
+
+        # Serve the cached bytes directly; wrapping them in a file object adds a copy
+        # and hides the Content-Length behind chunked reads
+        return Response(
+            pdf,
+            mimetype="application/pdf",
+            headers={**headers, "Content-Disposition": "attachment; filename=portfolio_report.pdf"},
+        )
+
+    except TimeoutError:
+        logging.error("Portfolio report generation timed out")
+        return "Report generation timed out, please retry", 504
     except Exception as e:
-        traceback.print_exc()
+        logging.exception("Portfolio report generation failed")
         return f"Failed to generate report: {e}", 500
-        
+
+
 if __name__ == "__main__":
+    if not DEBUG_MODE:
+        raise SystemExit(
+            "The Flask dev server is for development only (set FLASK_ENV=development). "
+            "For production, run `gunicorn app:app` from the DSPY_GPT directory."
+        )
+    # A single process has no workers to race, so upgrade in place instead of serving
+    # an app whose history table is missing columns
+    with app.app_context():
+        applied = upgrade_schema(db.engine)
+    if applied:
+        logging.info("Applied schema upgrades: %s", ", ".join(applied))
     # Disable auto-reload to prevent connection resets when library files change
     app.run(host="0.0.0.0", port=PORT, debug=True, use_reloader=False)
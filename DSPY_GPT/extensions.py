@@ -1,2 +1,7 @@
+from flask_caching import Cache
+from flask_compress import Compress
 from flask_sqlalchemy import SQLAlchemy
-db = SQLAlchemy()
\ No newline at end of file
+db = SQLAlchemy()
+# Shared across workers: Redis when REDIS_URL is set, else a filesystem cache
+cache = Cache()
+compress = Compress()
\ No newline at end of file
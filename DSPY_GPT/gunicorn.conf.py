@@ -0,0 +1,40 @@
+import multiprocessing
+import os
+import subprocess
+import sys
+
+from dotenv import load_dotenv
+
+# Read .env here too, so PORT and LOG_FILE apply before the workers start
+load_dotenv()
+
+# ---------------------------------------------------------------------
+# Production server settings, picked up by `gunicorn app:app` run from this directory
+# ---------------------------------------------------------------------
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# Threads overlap the I/O-bound yfinance and OpenAI calls inside each process;
+# one worker per core spreads the CPU-bound rendering. Per-session analyses and
+# reports live in the shared cache, so any worker can serve a follow-up request.
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+
+# Workers inherit this before importing the app: unless LOG_FILE is set, log to
+# stderr for the process manager to collect instead of having every worker
+# append to app.log. A LOG_FILE should be rotated by an external logrotate.
+os.environ.setdefault("LOG_FILE", "")
+
+# Streamed analyses can take a while to complete
+timeout = 120
+
+
+def on_starting(server):
+    # Upgrade the database schema once, in the master, before any worker imports the app
+    here = os.path.dirname(os.path.abspath(__file__))
+    subprocess.run(
+        [sys.executable, "-m", "flask", "--app", "app", "upgrade-db"],
+        cwd=here,
+        env={**os.environ, "PYTHONPATH": here, "YF_WARMUP": "0"},
+        check=True,
+    )
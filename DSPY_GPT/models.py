@@ -1,5 +1,4 @@
 from extensions import db
-from datetime import datetime
 
 # ---------------------------------------------------------------------
 # Task 2: Create your model here 
@@ -21,7 +20,9 @@ class AnalysisHistory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     ticker = db.Column(db.String(10), nullable=False)
     analysis = db.Column(db.Text, nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Markdown rendered once at creation so views never re-parse it
+    analysis_html = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, server_default=db.func.current_timestamp(), index=True)
 
     def __repr__(self):
         return f'<AnalysisHistory {self.ticker}>'
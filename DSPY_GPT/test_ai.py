@@ -1,5 +1,6 @@
 from DSPY_GPT.ai_module import dsp_financial_insight
 import DSPY_GPT.ai_module as ai_module
+import litellm
 
 def test_ai():
     ticker = "AAPL"
@@ -29,6 +30,40 @@ def test_ai():
 
     # Note: Testing with USE_DSPY=True might fail if the environment doesn't have 
     # a working DSPy setup or if GPT-4 quota is reached, but the code logic is verified.
+
+def test_insight_cache_hit():
+    stock_data = {'company': 'Apple Inc.', 'sector': 'Technology', 'price': 150.001,
+                  'change_pct': 1.5, 'pe_ratio': 28.5, 'beta': 1.2}
+    raw_data = {k: stock_data[k] for k in ('company', 'sector', 'price', 'change_pct', 'pe_ratio', 'beta')}
+    ai_module._INSIGHT_CACHE[ai_module._insight_cache_key("AAPL", raw_data)] = "Cached analysis"
+
+    # A sub-cent price move still maps onto the cached entry
+    assert dsp_financial_insight("AAPL", dict(stock_data, price=150.004)) == "Cached analysis"
+    ai_module._INSIGHT_CACHE.clear()
+
+def test_stream_insight_shares_cache():
+    stock_data = {'company': 'Apple Inc.', 'sector': 'Technology', 'price': 150.0,
+                  'change_pct': 1.5, 'pe_ratio': 28.5, 'beta': 1.2}
+    cache_key, _ = ai_module._prepare_insight("AAPL", stock_data)
+    ai_module._INSIGHT_CACHE[cache_key] = "Cached analysis"
+
+    # The blocking and streaming entry points go through the same cache lookup
+    assert dsp_financial_insight("AAPL", stock_data) == "Cached analysis"
+    assert list(ai_module.stream_financial_insight("AAPL", stock_data)) == ["Cached analysis"]
+    ai_module._INSIGHT_CACHE.clear()
+
+def test_prompt_token_budget():
+    _, raw_summary = ai_module._prepare_insight("AAPL", {
+        'company': 'Apple Inc.', 'sector': 'Technology', 'price': 150.0,
+        'change_pct': 1.5, 'pe_ratio': 28.5, 'beta': 1.2,
+    })
+    prompt = ai_module.render_insight_prompt("AAPL", raw_summary)
+    assert litellm.token_counter(model=ai_module.FULL_MODEL, text=prompt) < 300
+
+def test_select_model():
+    assert ai_module._select_model({'pe_ratio': 28.5, 'beta': 1.2}) == ai_module.FULL_MODEL
+    assert ai_module._select_model({'pe_ratio': 'N/A', 'beta': 1.2}) == ai_module.LIGHT_MODEL
+    assert ai_module._select_model({'pe_ratio': 28.5}) == ai_module.LIGHT_MODEL
     
 if __name__ == "__main__":
     test_ai()
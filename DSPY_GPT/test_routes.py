@@ -1,6 +1,13 @@
 import unittest
 import json
-from app import app, db
+import os
+import sqlite3
+import tempfile
+from unittest import mock
+from sqlalchemy import create_engine, inspect
+from ai_module import InsightStreamError
+from app import app, cache, db, _cached_quotes, _save_history, _store_analysis, _HISTORY_QUEUE, upgrade_schema
+from models import AnalysisHistory
 
 class TestRoutes(unittest.TestCase):
     def setUp(self):
@@ -39,6 +46,40 @@ class TestRoutes(unittest.TestCase):
                                    content_type='application/json')
         self.assertEqual(response.status_code, 404)
 
+    def test_analyze_stream_empty_ticker(self):
+        """Test /api/analyze/stream without a ticker."""
+        response = self.client.get('/api/analyze/stream?ticker=')
+        self.assertEqual(response.status_code, 400)
+
+    def test_analyze_stream_events(self):
+        """Test /api/analyze/stream emits stock, insight and done events."""
+        response = self.client.get('/api/analyze/stream?ticker=AAPL')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        body = response.get_data(as_text=True)
+        self.assertTrue(body.startswith('event: stock'))
+        self.assertIn('"text":', body)
+        self.assertTrue(body.rstrip().endswith('{"ticker":"AAPL"}'))
+
+    def test_analyze_stream_interrupted(self):
+        """Test a stream that breaks part-way ends with an error event and stores nothing."""
+        def broken_stream(ticker, stock_data):
+            yield "Apple looks "
+            yield "strong because"
+            raise InsightStreamError("stream interrupted")
+
+        with mock.patch('app.stream_financial_insight', broken_stream), \
+                mock.patch('app._save_history') as save_history:
+            response = self.client.get('/api/analyze/stream?ticker=AAPL')
+            body = response.get_data(as_text=True)
+            with self.client.session_transaction() as sess:
+                aid = sess['aid']
+
+        self.assertIn('event: error', body)
+        self.assertNotIn('event: done', body)
+        save_history.assert_not_called()
+        self.assertIsNone(cache.get(f'analysis:{aid}'))
+
     def test_insight_summary_no_session(self):
         """Test /insight_summary without a session (should show error page)."""
         response = self.client.get('/insight_summary')
@@ -48,15 +89,14 @@ class TestRoutes(unittest.TestCase):
     def test_insight_summary_with_session(self):
         """Test /insight_summary with a session."""
         with self.client.session_transaction() as sess:
-            sess['latest_analysis'] = {
-                'ticker': 'TSLA',
-                'company': 'Tesla, Inc.',
-                'price': 250.0,
-                'change_pct': 2.5,
-                'pe_ratio': 70.0,
-                'beta': 2.0,
-                'insight': '### Analysis\nTesla is leading the EV market.'
-            }
+            sess['aid'] = 'test-aid'
+        _store_analysis('test-aid', 'TSLA', {
+            'company': 'Tesla, Inc.',
+            'price': 250.0,
+            'change_pct': 2.5,
+            'pe_ratio': 70.0,
+            'beta': 2.0,
+        }, '### Analysis\nTesla is leading the EV market.')
         response = self.client.get('/insight_summary')
         self.assertEqual(response.status_code, 200)
         self.assertIn(b'Tesla, Inc.', response.data)
@@ -89,6 +129,24 @@ class TestRoutes(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(data['quantity'], 75.0)
 
+    def test_portfolio_upsert_fallback(self):
+        """Test a backend without ON CONFLICT support still adds and increments holdings."""
+        self.client.post('/api/portfolio/delete',
+                         data=json.dumps({'ticker': 'ORCL'}),
+                         content_type='application/json')
+        with mock.patch.dict('app._UPSERT_INSERTS', clear=True):
+            first = self.client.post('/api/portfolio',
+                                     data=json.dumps({'ticker': 'ORCL', 'quantity': 4}),
+                                     content_type='application/json')
+            second = self.client.post('/api/portfolio',
+                                      data=json.dumps({'ticker': 'ORCL', 'quantity': 6}),
+                                      content_type='application/json')
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(json.loads(first.data)['quantity'], 4.0)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(json.loads(second.data)['quantity'], 10.0)
+
     def test_portfolio_add_invalid_data(self):
         """Test validation errors for /api/portfolio."""
         # Missing ticker
@@ -139,5 +197,138 @@ class TestRoutes(unittest.TestCase):
         # PDF headers usually start with %PDF
         self.assertTrue(response.data.startswith(b'%PDF'))
 
+    def test_portfolio_report_quote_failure_not_cached(self):
+        """Test a failed quote lookup is retried on the next view and its report is not cached."""
+        self.client.post('/api/portfolio',
+                         data=json.dumps({'ticker': 'IBM', 'quantity': 3}),
+                         content_type='application/json')
+        cache.clear()
+        _cached_quotes.cache_clear()
+
+        with mock.patch('app.get_stock_data_bulk', side_effect=RuntimeError('Yahoo unavailable')) as bulk:
+            first = self.client.get('/report/portfolio.pdf')
+            self.client.get('/report/portfolio.pdf')
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.headers['Cache-Control'], 'no-store')
+        self.assertNotIn('ETag', first.headers)
+        self.assertEqual(bulk.call_count, 2)
+
+    def test_portfolio_report_conditional_get(self):
+        """Test a repeat report request carrying the ETag gets 304 with no body."""
+        self.client.post('/api/portfolio',
+                         data=json.dumps({'ticker': 'AAPL', 'quantity': 10}),
+                         content_type='application/json')
+
+        # Pin the clock so both requests fall in the same minute
+        with mock.patch('app.time') as clock, \
+                mock.patch('app.get_stock_data_bulk', return_value={'AAPL': {'price': 100.0}}):
+            clock.time.return_value = 1_700_000_000.0
+            first = self.client.get('/report/portfolio.pdf')
+            second = self.client.get('/report/portfolio.pdf',
+                                     headers={'If-None-Match': first.headers['ETag']})
+
+        self.assertEqual(first.status_code, 200)
+        self.assertTrue(first.headers['ETag'].startswith('W/'))
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(second.data, b'')
+        self.assertEqual(second.headers['ETag'], first.headers['ETag'])
+
+    def test_portfolio_report_shared_cache(self):
+        """Test a generated report is stored under pdf:<digest> and served from there."""
+        self.client.post('/api/portfolio',
+                         data=json.dumps({'ticker': 'AAPL', 'quantity': 10}),
+                         content_type='application/json')
+        cache.clear()
+        _cached_quotes.cache_clear()
+
+        with mock.patch('app.time') as clock, \
+                mock.patch('app.get_stock_data_bulk', return_value={'AAPL': {'price': 100.0}}) as bulk:
+            clock.time.return_value = 1_700_000_000.0
+            first = self.client.get('/report/portfolio.pdf')
+            # Another worker has its own quote cache but shares the PDF cache
+            _cached_quotes.cache_clear()
+            second = self.client.get('/report/portfolio.pdf')
+
+        digest = first.headers['ETag'][len('W/"'):-1]
+        self.assertEqual(cache.get(f'pdf:{digest}'), first.data)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(bulk.call_count, 1)
+
+    def test_history_saved_in_background(self):
+        """Test a queued analysis is in the history table once the writer drains the queue."""
+        _save_history('ZZHIST', '**Buy**', '<p><strong>Buy</strong></p>')
+        _HISTORY_QUEUE.join()
+
+        with app.app_context():
+            rows = AnalysisHistory.query.filter_by(ticker='ZZHIST').all()
+            try:
+                self.assertEqual(len(rows), 1)
+                self.assertEqual(rows[0].analysis, '**Buy**')
+                self.assertEqual(rows[0].analysis_html, '<p><strong>Buy</strong></p>')
+                self.assertIsNotNone(rows[0].created_at)
+            finally:
+                AnalysisHistory.query.filter_by(ticker='ZZHIST').delete()
+                db.session.commit()
+
+    def test_portfolio_oversized_payload(self):
+        """Test that an oversized /api/portfolio body is rejected with 413."""
+        response = self.client.post('/api/portfolio',
+                                   data=json.dumps({'ticker': 'AAPL', 'quantity': 1, 'pad': 'x' * 5000}),
+                                   content_type='application/json')
+        self.assertEqual(response.status_code, 413)
+
+class TestSchemaUpgrade(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'old.db')
+        # analysis_history as first released: no analysis_html, no created_at default or index
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE analysis_history (id INTEGER PRIMARY KEY, ticker VARCHAR(10) NOT NULL, '
+                     'analysis TEXT NOT NULL, created_at DATETIME)')
+        conn.execute("INSERT INTO analysis_history (ticker, analysis, created_at) "
+                     "VALUES ('AAPL', 'Solid quarter', '2024-01-02 03:04:05')")
+        conn.commit()
+        conn.close()
+        self.engine = create_engine(f'sqlite:///{path}')
+        self.addCleanup(self.engine.dispose)
+
+    def test_upgrade_twice(self):
+        """Test upgrading an old database applies every step once and keeps its rows."""
+        self.assertEqual(upgrade_schema(self.engine), ['analysis_html', 'created_at_default', 'indexes'])
+        self.assertEqual(upgrade_schema(self.engine), [])
+
+        inspector = inspect(self.engine)
+        columns = {c['name']: c for c in inspector.get_columns('analysis_history')}
+        self.assertIn('analysis_html', columns)
+        self.assertIsNotNone(columns['created_at']['default'])
+        self.assertIn('ix_analysis_history_created_at',
+                      {i['name'] for i in inspector.get_indexes('analysis_history')})
+        self.assertFalse(inspector.has_table('analysis_history_old'))
+
+        with self.engine.connect() as conn:
+            rows = conn.exec_driver_sql('SELECT id, ticker, analysis, created_at FROM analysis_history').all()
+            self.assertEqual([tuple(r) for r in rows], [(1, 'AAPL', 'Solid quarter', '2024-01-02 03:04:05')])
+            # New rows are stamped by the database default
+            conn.exec_driver_sql("INSERT INTO analysis_history (ticker, analysis) VALUES ('MSFT', 'x')")
+            self.assertIsNotNone(conn.exec_driver_sql(
+                "SELECT created_at FROM analysis_history WHERE ticker = 'MSFT'").scalar())
+
+    def test_failed_upgrade_rolls_back(self):
+        """Test an upgrade that fails part-way leaves the old table and its rows untouched."""
+        with mock.patch.object(AnalysisHistory.__table__, 'create', side_effect=RuntimeError('disk full')):
+            with self.assertRaises(RuntimeError):
+                upgrade_schema(self.engine)
+
+        inspector = inspect(self.engine)
+        self.assertEqual(inspector.get_table_names(), ['analysis_history'])
+        self.assertNotIn('analysis_html', {c['name'] for c in inspector.get_columns('analysis_history')})
+        with self.engine.connect() as conn:
+            self.assertEqual(conn.exec_driver_sql('SELECT COUNT(*) FROM analysis_history').scalar(), 1)
+
+        self.assertEqual(upgrade_schema(self.engine), ['analysis_html', 'created_at_default', 'indexes'])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,12 @@
+from unittest import mock
 from DSPY_GPT.utils import get_stock_data, history_to_dataframe
+import DSPY_GPT.utils as utils
 import pandas as pd
 
 def test_utils():
     ticker = "AAPL"
     print(f"Fetching data for {ticker}...")
-    data = get_stock_data(ticker)
+    data = get_stock_data(ticker, include_history=True)
     
     # Check keys
     expected_keys = ['price', 'pct_change', 'name', 'pe_ratio', 'beta', 'sector', 'history']
@@ -30,5 +32,18 @@ def test_utils():
     else:
         print("FAILED: History conversion to DataFrame failed or returned empty.")
 
+def test_empty_lookup_not_cached():
+    # yfinance hides a failed download behind an empty frame instead of raising
+    ticker = "ZZEMPTY"
+    with mock.patch.object(utils.yf, "Ticker") as yf_ticker:
+        yf_ticker.return_value.info = {}
+        yf_ticker.return_value.history.return_value = pd.DataFrame()
+        get_stock_data(ticker, include_history=True)
+        get_stock_data(ticker, include_history=True)
+
+    assert ticker not in utils._INFO_CACHE
+    assert ticker not in utils._HISTORY_CACHE
+    assert yf_ticker.return_value.history.call_count == 2
+
 if __name__ == "__main__":
     test_utils()
@@ -1,19 +1,48 @@
 import yfinance as yf
 import json
+import logging
+from threading import Lock
+
 import pandas as pd
 from pandas import Timestamp  
+from cachetools import TTLCache
 
 # ---------------------------------------------------------------------
 # Task 3: Create Utility Functions to Fetch, Analyze, and Format Stock Market Data
 # ---------------------------------------------------------------------
 
-def get_stock_data(ticker):
+# Quote metadata only needs to be fresh to the minute; the 30-day bars barely
+# move intraday. Failed lookups are never stored: yfinance either raises or,
+# with its exceptions hidden, logs and returns an empty dict/DataFrame.
+_INFO_CACHE = TTLCache(maxsize=2048, ttl=60)
+_HISTORY_CACHE = TTLCache(maxsize=2048, ttl=3600)
+_CACHE_LOCK = Lock()
+
+def _cached_fetch(cache, ticker, fetch):
+    with _CACHE_LOCK:
+        hit = cache.get(ticker)
+    if hit is not None:
+        return hit
+
+    value = fetch()
+    if len(value):
+        with _CACHE_LOCK:
+            cache[ticker] = value
+    return value
+
+def _get_info(ticker):
+    return _cached_fetch(_INFO_CACHE, ticker, lambda: yf.Ticker(ticker).info)
+
+def _get_history(ticker):
+    return _cached_fetch(_HISTORY_CACHE, ticker, lambda: yf.Ticker(ticker).history(period="1mo"))
+
+def get_stock_data(ticker, include_history=False):
     """
     Fetches financial information for a given stock symbol using yfinance.
+    The 30-day price history is only downloaded when include_history is set.
     """
     try:
-        stock = yf.Ticker(ticker)
-        info = stock.info
+        info = _get_info(ticker)
         
         # Latest price and metrics
         price = info.get('currentPrice', 0.0)
@@ -23,38 +52,79 @@ def get_stock_data(ticker):
         beta = info.get('beta', 'N/A')
         sector = info.get('sector', 'N/A')
         
-        # 30-day historical data
-        history = stock.history(period="1mo")
-        # Reset index to include Date as a column before converting to JSON
-        history_json = history.reset_index().to_json(date_format='iso', orient='records')
-        
-        return {
+        data = {
             'price': price,
             'pct_change': pct_change,
             'name': name,
             'pe_ratio': pe_ratio,
             'beta': beta,
             'sector': sector,
-            'history': history_json
         }
+        if include_history:
+            # 30-day historical data, kept as a DataFrame; callers serialize only if they need to.
+            # Shared with the cache, so treat it as read-only.
+            data['history'] = _get_history(ticker)
+        return data
     except Exception as e:
-        print(f"Error fetching data for {ticker}: {e}")
-        return {
+        logging.warning("Error fetching data for %s: %s", ticker, e)
+        data = {
             'price': 0.0,
             'pct_change': 0.0,
             'name': 'Error',
             'pe_ratio': 'N/A',
             'beta': 'N/A',
             'sector': 'N/A',
-            'history': '[]'
         }
+        if include_history:
+            data['history'] = pd.DataFrame()
+        return data
+
+def get_stock_data_bulk(tickers):
+    """
+    Fetches the latest price and daily change for many stock symbols in one batched yfinance call.
+    Returns a dict keyed by ticker; symbols without quotes are omitted.
+    Raises when the download fails or returns no quotes at all, so callers never cache an outage.
+    """
+    tickers = list(dict.fromkeys(tickers))
+    if not tickers:
+        return {}
+
+    # yfinance reports most network failures as an empty frame rather than raising
+    frame = yf.download(tickers, period="5d", progress=False, threads=True)
+    closes = frame["Close"]
+
+    quotes = {}
+    for ticker in tickers:
+        if ticker not in closes.columns:
+            continue
+        series = closes[ticker].dropna()
+        if series.empty:
+            continue
+
+        price = float(series.iloc[-1])
+        pct_change = float((series.iloc[-1] / series.iloc[-2] - 1) * 100) if len(series) > 1 else 0.0
+        quotes[ticker] = {'price': price, 'pct_change': pct_change}
+
+    if not quotes:
+        raise RuntimeError(f"No quotes returned for {', '.join(tickers)}")
+    return quotes
 
-def history_to_dataframe(history_json):
+def history_to_json(history):
     """
-    Converts the stock history data (in JSON format) into a pandas DataFrame.
+    Serializes a stock history DataFrame to JSON records with the Date as a column.
     """
+    # Reset index to include Date as a column before converting to JSON
+    return history.reset_index().to_json(date_format='iso', orient='records')
+
+def history_to_dataframe(history):
+    """
+    Converts the stock history data (a DataFrame or its JSON records) into a pandas DataFrame.
+    """
+    if isinstance(history, pd.DataFrame):
+        return history.sort_index()
+
     try:
-        data = json.loads(history_json)
+        data = json.loads(history)
         df = pd.DataFrame(data)
         
         if not df.empty:
@@ -72,5 +142,5 @@ def history_to_dataframe(history_json):
             
         return df
     except Exception as e:
-        print(f"Error converting history to dataframe: {e}")
+        logging.warning("Error converting history to dataframe: %s", e)
         return pd.DataFrame()